@@ -27,6 +27,7 @@ from FreeCAD import Units
 import Path
 import argparse
 import datetime
+import numpy
 import shlex
 from PathScripts import PostUtils
 
@@ -89,6 +90,16 @@ parser.add_argument(
 parser.add_argument(
     "--axis-modal", action="store_true", help="Output the Same Axis Value Mode"
 )
+parser.add_argument(
+    "--bounds-check",
+    action="store_true",
+    help="check the operations against the machine limits before output",
+)
+parser.add_argument(
+    "--sequence-tools",
+    action="store_true",
+    help="reorder operations to group them by tool and reduce manual tool changes",
+)
 
 TOOLTIP_ARGS = parser.format_help()
 
@@ -113,14 +124,25 @@ DRILL_RETRACT_MODE = "G98"  # End of drill-cycle retractation type. G99
 TRANSLATE_DRILL_CYCLES = True  # If true, G81, G82, and G83 are translated
 # into G0/G1 moves
 
+SEQUENCE_TOOLS = False  # If true, operations are regrouped by tool before output
+TOOL_CHANGE_MINUTES = 2.5  # Estimated duration of one manual tool change
+RAPID_SPEED = 3000.0  # mm/min, used to estimate time spent on rapids between ops
+SEQUENCE_AFTER_PROPERTY = "SequenceAfter"  # Optional property on an operation
+# holding the labels of the operations that must be output before it
+
 # These globals will be reflected in the Machine configuration of the project
 UNITS = "G21"  # G21 for metric, G20 for us standard
 UNIT_SPEED_FORMAT = "mm/min"
 UNIT_FORMAT = "mm"
 
 MACHINE_NAME = "MarlinCNC"
+# Machine limits, in machine coordinates (G53). The paths are output in the
+# work coordinate system (G55), WORK_OFFSET is the G55 origin in machine
+# coordinates and is added to the path coordinates before they are checked.
 CORNER_MIN = {"x": 0, "y": 0, "z": 0}
 CORNER_MAX = {"x": 800, "y": 1270, "z": 50}
+WORK_OFFSET = {"x": 0, "y": 0, "z": 0}
+CHECK_BOUNDS = False  # If true, posting stops when a move is outside the corners
 PRECISION = 3
 
 # Preamble text will appear at the beginning of the GCODE output file.
@@ -171,8 +193,8 @@ def processArguments(argstring):
     global TRANSLATE_DRILL_CYCLES
     global MODAL
     global OUTPUT_DOUBLES
-    
-
+    global SEQUENCE_TOOLS
+    global CHECK_BOUNDS
 
     try:
         args = parser.parse_args(shlex.split(argstring))
@@ -204,6 +226,10 @@ def processArguments(argstring):
         if args.axis_modal:
             print("here")
             OUTPUT_DOUBLES = False
+        if args.bounds_check:
+            CHECK_BOUNDS = True
+        if args.sequence_tools:
+            SEQUENCE_TOOLS = True
 
     except Exception:
         return False
@@ -228,14 +254,30 @@ def export(objectslist, filename, argstring):
             )
             return None
 
+    if CHECK_BOUNDS:
+        for obj in objectslist:
+            if not is_active(obj):
+                continue
+            error = check_bounds(obj)
+            if error:
+                print("outside machine limits, " + error)
+                return None
+
     print("postprocessing...")
     gcode = ""
+    sequence_report = []
+
+    if SEQUENCE_TOOLS:
+        objectslist, sequence_report = sequence_operations(objectslist)
 
     # write header
     if OUTPUT_HEADER:
         gcode += linenumber() + "(Exported by FreeCAD)\n"
         gcode += linenumber() + "(Post Processor: " + __name__ + ")\n"
         gcode += linenumber() + "(Output Time:" + str(now) + ")\n"
+    if OUTPUT_COMMENTS:
+        for line in sequence_report:
+            gcode += linenumber() + ";(" + line + ")\n"
 
     # Suppress drill-cycle commands:
     if TRANSLATE_DRILL_CYCLES:
@@ -251,12 +293,8 @@ def export(objectslist, filename, argstring):
     for obj in objectslist:
 
         # Skip inactive operations
-        if hasattr(obj, "Active"):
-            if not obj.Active:
-                continue
-        if hasattr(obj, "Base") and hasattr(obj.Base, "Active"):
-            if not obj.Base.Active:
-                continue
+        if not is_active(obj):
+            continue
 
         # do the pre_op
         if OUTPUT_COMMENTS:
@@ -345,6 +383,400 @@ def format_outstring(strTable):
         s += w + COMMAND_SPACE
     return s.strip()
 
+def is_active(obj):
+    # operations (and dressups of operations) that are switched off are skipped
+    if hasattr(obj, "Active"):
+        if not obj.Active:
+            return False
+    if hasattr(obj, "Base") and hasattr(obj.Base, "Active"):
+        if not obj.Base.Active:
+            return False
+    return True
+
+
+# *****************************************************************************
+# * Every M6 on this machine is a manual tool change: park, M0 pause and      *
+# * re-home. With --sequence-tools the operations are regrouped by tool       *
+# * before output, while keeping operations that depend on each other in      *
+# * their original order.                                                     *
+# *****************************************************************************
+def op_toolcontroller(obj):
+    # tool controller of an operation, None if it has no tool controller
+    while obj is not None:
+        tc = getattr(obj, "ToolController", None)
+        if tc is not None and hasattr(tc, "ToolNumber"):
+            return tc
+        base = getattr(obj, "Base", None)
+        obj = base if hasattr(base, "Path") else None  # follow dressups
+    return None
+
+
+def op_features(obj):
+    # list of (object name, bounding box) the operation machines, None for the
+    # whole model. The box is None when the subelement shape is not available.
+    while hasattr(getattr(obj, "Base", None), "Path"):  # follow dressups
+        obj = obj.Base
+    features = []
+    base = getattr(obj, "Base", None)
+    if isinstance(base, (list, tuple)):
+        for entry in base:
+            try:
+                model, subs = entry
+            except (TypeError, ValueError):
+                continue
+            if isinstance(subs, str):
+                subs = [subs]
+            name = getattr(model, "Name", str(model))
+            for sub in subs:
+                try:
+                    box = model.Shape.getElement(sub).BoundBox
+                except Exception:
+                    box = None
+                features.append((name, box))
+    if not features:
+        return None
+    return features
+
+
+def boxes_overlap(a, b):
+    # bounding boxes that touch count as overlapping
+    return (
+        a.XMin <= b.XMax
+        and b.XMin <= a.XMax
+        and a.YMin <= b.YMax
+        and b.YMin <= a.YMax
+        and a.ZMin <= b.ZMax
+        and b.ZMin <= a.ZMax
+    )
+
+
+def features_overlap(a, b):
+    # Subelements of the same object overlap when their bounding boxes do, so
+    # a finishing pass on the edges of a face depends on roughing that face.
+    # Without shape information every subelement of the object overlaps.
+    if a is None or b is None:
+        return True
+    for name_a, box_a in a:
+        for name_b, box_b in b:
+            if name_a != name_b:
+                continue
+            if box_a is None or box_b is None or boxes_overlap(box_a, box_b):
+                return True
+    return False
+
+
+def op_endpoints(obj):
+    # first and last XY position reached by the operation
+    start = None
+    end = None
+    x = None
+    y = None
+    for c in obj.Path.Commands:
+        if "X" in c.Parameters:
+            x = c.Parameters["X"]
+        if "Y" in c.Parameters:
+            y = c.Parameters["Y"]
+        if x is not None and y is not None:
+            if start is None:
+                start = (x, y)
+            end = (x, y)
+    return start, end
+
+
+def rapid_distance(a, b):
+    if a is None or b is None:
+        return 0.0
+    return ((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2) ** 0.5
+
+
+def count_tool_changes(tools):
+    changes = 0
+    current = None
+    for tool in tools:
+        if tool is not None and tool != current:
+            changes += 1
+            current = tool
+    return changes
+
+
+def sequence_operations(objectslist):
+    # Returns the reordered objectslist and report lines.
+    # Tool controllers are dropped and re-inserted in front of the first
+    # operation of each tool group. Inactive operations are left out, export()
+    # would skip them anyway.
+    leading = []
+    toolcontrollers = {}
+    ops = []
+    for obj in objectslist:
+        if hasattr(obj, "ToolNumber"):
+            toolcontrollers[obj.Name] = obj
+        elif not hasattr(obj, "Path"):
+            if not ops:
+                leading.append(obj)
+        elif is_active(obj):
+            ops.append(obj)
+
+    count = len(ops)
+    # Operations are grouped by tool controller, not by tool number: every
+    # tool controller in the output is an M6 and so a manual tool change.
+    tools = []
+    for op in ops:
+        tc = op_toolcontroller(op)
+        tools.append(tc.Name if tc is not None else None)
+    features = [op_features(op) for op in ops]
+    endpoints = [op_endpoints(op) for op in ops]
+    labels = dict((op.Label, i) for i, op in enumerate(ops))
+
+    # Build the dependency graph. An operation depends on every earlier
+    # operation that machines an overlapping feature (e.g. roughing before
+    # finishing the same face). Operations without a Base (whole model,
+    # fixtures) overlap everything and so keep their place. Explicit
+    # dependencies are taken from the SEQUENCE_AFTER_PROPERTY of the operation.
+    depends = [set() for i in range(count)]
+    for j in range(count):
+        for i in range(j):
+            if features_overlap(features[i], features[j]):
+                depends[j].add(i)
+        after = getattr(ops[j], SEQUENCE_AFTER_PROPERTY, None) or []
+        if isinstance(after, str):
+            after = [after]
+        for label in after:
+            if label in labels and labels[label] != j:
+                depends[j].add(labels[label])
+
+    # Greedy topological order: stay on the current tool as long as possible,
+    # then switch to the tool with the most operations ready to run. Within a
+    # tool, pick the ready operation closest to the current position.
+    order = []
+    done = set()
+    current_tool = None
+    position = None
+    cycle = False
+    while len(order) < count:
+        ready = [
+            i for i in range(count) if i not in done and depends[i] <= done
+        ]
+        if not ready:  # dependency cycle, keep the remaining original order
+            cycle = True
+            ready = [min(i for i in range(count) if i not in done)]
+        same = [i for i in ready if tools[i] is None or tools[i] == current_tool]
+        if not same:
+            ready_per_tool = {}
+            for i in ready:
+                ready_per_tool[tools[i]] = ready_per_tool.get(tools[i], 0) + 1
+            best = max(ready_per_tool.values())
+            same = [i for i in ready if ready_per_tool[tools[i]] == best]
+        nearest = min(
+            same, key=lambda i: (rapid_distance(position, endpoints[i][0]), i)
+        )
+        order.append(nearest)
+        done.add(nearest)
+        if tools[nearest] is not None:
+            current_tool = tools[nearest]
+        if endpoints[nearest][1] is not None:
+            position = endpoints[nearest][1]
+
+    def travel(sequence):
+        distance = 0.0
+        position = None
+        for i in sequence:
+            distance += rapid_distance(position, endpoints[i][0])
+            if endpoints[i][1] is not None:
+                position = endpoints[i][1]
+        return distance
+
+    changes_before = count_tool_changes(tools)
+    changes_after = count_tool_changes([tools[i] for i in order])
+    travel_before = travel(range(count))
+    travel_after = travel(order)
+
+    report = []
+    if cycle:
+        report.append(
+            "tool sequencing: dependency cycle, remaining operations kept in "
+            "original order"
+        )
+
+    # The greedy order is not always better, only use it when it saves tool
+    # changes, or the same tool changes with less rapid travel.
+    if changes_after > changes_before or (
+        changes_after == changes_before and travel_after >= travel_before
+    ):
+        report += [
+            "tool sequencing: tool changes %d, no better order found" % changes_before,
+            "tool sequencing: original order kept",
+        ]
+        for line in report:
+            print(line)
+        return objectslist, report
+
+    # Rebuild the objects list, inserting the tool controller on each change.
+    result = list(leading)
+    current_tool = None
+    for i in order:
+        if tools[i] is not None and tools[i] != current_tool:
+            if tools[i] in toolcontrollers:
+                result.append(toolcontrollers[tools[i]])
+            current_tool = tools[i]
+        result.append(ops[i])
+
+    minutes_saved = (changes_before - changes_after) * TOOL_CHANGE_MINUTES + (
+        travel_before - travel_after
+    ) / RAPID_SPEED
+
+    report += [
+        "tool sequencing: tool changes %d -> %d" % (changes_before, changes_after),
+        "tool sequencing: rapids between operations %.1f -> %.1f mm"
+        % (travel_before, travel_after),
+        "tool sequencing: estimated %.1f minutes saved" % minutes_saved,
+    ]
+    for line in report:
+        print(line)
+
+    return result, report
+
+
+# *****************************************************************************
+# * Soft-limit check (--bounds-check): every operation's XYZ envelope is      *
+# * moved by WORK_OFFSET and compared with CORNER_MIN/CORNER_MAX before any   *
+# * gcode is formatted, so an out of range move is reported right away        *
+# * instead of as a Marlin software endstop hit. Arcs include their extents   *
+# * from I/J or R, drill cycles include their R plane.                        *
+# *****************************************************************************
+def command_envelopes(commands):
+    # per command minimum and maximum XYZ reached, NaN where unknown
+    count = len(commands)
+    values = numpy.full((count, 6), numpy.nan)  # X Y Z I J R
+    kind = numpy.zeros(count, dtype=int)  # 0 other, 1 move, 2 cw, 3 ccw, 4 drill
+    for k, c in enumerate(commands):
+        name = c.Name
+        if name in MOTION_COMMANDS:
+            kind[k] = 1
+            if name in ("G2", "G02"):
+                kind[k] = 2
+            elif name in ("G3", "G03"):
+                kind[k] = 3
+        elif name in ("G81", "G82", "G83"):
+            kind[k] = 4
+        else:
+            continue
+        params = c.Parameters  # FreeCAD builds a new dict on every access
+        values[k] = [params.get(param, numpy.nan) for param in "XYZIJR"]
+
+    # position after every command: carry the last given value forward
+    given = ~numpy.isnan(values[:, 0:3])
+    last = numpy.where(given, numpy.arange(count)[:, None], -1)
+    numpy.maximum.accumulate(last, axis=0, out=last)
+    position = values[numpy.maximum(last, 0), numpy.arange(3)]
+    position[last < 0] = numpy.nan
+
+    env_min = values[:, 0:3].copy()
+    env_max = values[:, 0:3].copy()
+
+    # drill cycles: rapid to R first, then down to Z
+    drill = kind == 4
+    env_max[drill, 2] = numpy.fmax(env_max[drill, 2], values[drill, 5])
+    env_min[drill, 2] = numpy.fmin(env_min[drill, 2], values[drill, 5])
+
+    # arcs: the end points are covered, add the axis extremes that are swept
+    arc = (kind == 2) | (kind == 3)
+    if arc.any():
+        previous = numpy.vstack((numpy.full((1, 3), numpy.nan), position[:-1]))
+        start = previous[arc, 0:2]
+        end = position[arc, 0:2]
+        offset = numpy.nan_to_num(values[arc, 3:5])
+        center = start + offset
+        radius = numpy.hypot(offset[:, 0], offset[:, 1])
+        cw = kind[arc] == 2
+
+        # Arcs given with R instead of I/J: the center is on the perpendicular
+        # of the chord, left of it for G3 and right for G2, on the other side
+        # for a negative R (more than half a circle). Arcs where the center
+        # can't be found (zero chord, R shorter than half the chord) get NaN
+        # extents and so are not checked beyond their end points.
+        r_word = values[arc, 5]
+        r_format = numpy.isnan(values[arc, 3]) & numpy.isnan(values[arc, 4])
+        r_format &= ~numpy.isnan(r_word)
+        if r_format.any():
+            chord = end[r_format] - start[r_format]
+            half = numpy.hypot(chord[:, 0], chord[:, 1]) / 2
+            arc_radius = numpy.abs(r_word[r_format])
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                rise = numpy.sqrt(arc_radius ** 2 - half ** 2)
+                left = numpy.column_stack((-chord[:, 1], chord[:, 0])) / (
+                    2 * half[:, None]
+                )
+            side = numpy.where(cw[r_format], -1.0, 1.0) * numpy.sign(r_word[r_format])
+            middle = (start[r_format] + end[r_format]) / 2
+            center[r_format] = middle + left * (side * rise)[:, None]
+            radius[r_format] = arc_radius
+
+        a_start = numpy.arctan2(start[:, 1] - center[:, 1], start[:, 0] - center[:, 0])
+        a_end = numpy.arctan2(end[:, 1] - center[:, 1], end[:, 0] - center[:, 0])
+        low = numpy.where(cw, a_end, a_start)  # counter clockwise from low
+        high = numpy.where(cw, a_start, a_end)
+        span = numpy.mod(high - low, 2 * numpy.pi)
+        span[numpy.isclose(span, 0)] = 2 * numpy.pi  # full circle
+
+        def swept(angle):
+            return numpy.mod(angle - low, 2 * numpy.pi) <= span
+
+        nan = numpy.full(len(radius), numpy.nan)
+        x_max = numpy.where(swept(0), center[:, 0] + radius, nan)
+        y_max = numpy.where(swept(numpy.pi / 2), center[:, 1] + radius, nan)
+        x_min = numpy.where(swept(numpy.pi), center[:, 0] - radius, nan)
+        y_min = numpy.where(swept(3 * numpy.pi / 2), center[:, 1] - radius, nan)
+        env_min[arc, 0] = numpy.fmin(env_min[arc, 0], x_min)
+        env_max[arc, 0] = numpy.fmax(env_max[arc, 0], x_max)
+        env_min[arc, 1] = numpy.fmin(env_min[arc, 1], y_min)
+        env_max[arc, 1] = numpy.fmax(env_max[arc, 1], y_max)
+
+    return env_min, env_max
+
+
+def check_bounds(pathobj):
+    # returns an error message for the first move outside the machine limits
+    if hasattr(pathobj, "Group"):  # We have a compound or project.
+        for p in pathobj.Group:
+            error = check_bounds(p)
+            if error:
+                return error
+        return None
+    if not hasattr(pathobj, "Path"):
+        return None
+
+    offset = numpy.array([WORK_OFFSET[axis] for axis in "xyz"], dtype=float)
+    env_min, env_max = command_envelopes(pathobj.Path.Commands)
+    env_min += offset  # work coordinates to machine coordinates
+    env_max += offset
+    corner_min = numpy.array([CORNER_MIN[axis] for axis in "xyz"], dtype=float)
+    corner_max = numpy.array([CORNER_MAX[axis] for axis in "xyz"], dtype=float)
+    with numpy.errstate(invalid="ignore"):  # NaN compares False, unknown is ok
+        below = env_min < corner_min
+        above = env_max > corner_max
+    outside = (below | above).any(axis=1)
+    if not outside.any():
+        return None
+
+    index = int(numpy.argmax(outside))
+    axis = int(numpy.argmax(below[index] | above[index]))
+    if below[index, axis]:
+        value = env_min[index, axis]
+        limit = "below minimum %s" % CORNER_MIN["xyz"[axis]]
+    else:
+        value = env_max[index, axis]
+        limit = "above maximum %s" % CORNER_MAX["xyz"[axis]]
+    return "operation %s, command %d (%s): %s%.3f (machine %.3f) is %s" % (
+        pathobj.Label,
+        index,
+        pathobj.Path.Commands[index].Name,
+        "XYZ"[axis],
+        value - offset[axis],
+        value,
+        limit,
+    )
+
+
 def parse(pathobj):
     global DRILL_RETRACT_MODE
     global PRECISION
@@ -0,0 +1,29 @@
+# The postprocessor imports FreeCAD modules at load time. When they are not
+# available (plain python test runs), minimal stand-ins are installed so the
+# pure helper functions can be tested.
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import FreeCAD  # noqa: F401
+except ImportError:
+
+    class Command:
+        def __init__(self, name, parameters=None):
+            self.Name = name
+            self.Parameters = dict(parameters or {})
+
+    freecad = types.ModuleType("FreeCAD")
+    freecad.GuiUp = False
+    freecad.Units = types.SimpleNamespace(Quantity=None, Length=None, Velocity=None)
+    path = types.ModuleType("Path")
+    path.Command = Command
+    pathscripts = types.ModuleType("PathScripts")
+    pathscripts.PostUtils = types.ModuleType("PathScripts.PostUtils")
+    sys.modules["FreeCAD"] = freecad
+    sys.modules["Path"] = path
+    sys.modules["PathScripts"] = pathscripts
+    sys.modules["PathScripts.PostUtils"] = pathscripts.PostUtils
@@ -0,0 +1,312 @@
+import types
+
+import numpy
+import pytest
+
+import Path
+
+import marlin_post
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def box(xmin, ymin, zmin, xmax, ymax, zmax):
+    return types.SimpleNamespace(
+        XMin=xmin, YMin=ymin, ZMin=zmin, XMax=xmax, YMax=ymax, ZMax=zmax
+    )
+
+
+class Shape(object):
+    def __init__(self, elements):
+        self.elements = elements
+
+    def getElement(self, name):
+        return types.SimpleNamespace(BoundBox=self.elements[name])
+
+
+MODEL = Obj(
+    Name="Body",
+    Shape=Shape(
+        {
+            "Face6": box(0, 0, 0, 40, 40, 10),
+            "Edge1": box(0, 0, 10, 40, 0, 10),
+            "Face9": box(100, 100, 0, 140, 140, 10),
+        }
+    ),
+)
+
+
+def path(*points):
+    return Obj(Commands=[Path.Command("G1", {"X": x, "Y": y}) for x, y in points])
+
+
+def toolcontroller(name, number):
+    return Obj(Name=name, Label=name, ToolNumber=number, Path=path())
+
+
+def operation(label, tc, subs, *points, **kwargs):
+    return Obj(
+        Label=label,
+        ToolController=tc,
+        Base=[(MODEL, subs)],
+        Path=path(*points),
+        **kwargs
+    )
+
+
+def labels(objectslist):
+    return [obj.Label for obj in objectslist]
+
+
+def test_count_tool_changes():
+    assert marlin_post.count_tool_changes([]) == 0
+    assert marlin_post.count_tool_changes(["T1", None, "T1", "T3", "T1"]) == 3
+
+
+def test_op_features_follows_dressups():
+    tc1 = toolcontroller("TC1", 1)
+    rough = operation("rough", tc1, ("Face6",), (0, 0))
+    dogbone = Obj(Label="dogbone", Base=rough, Path=path((0, 0)))
+    assert marlin_post.op_features(dogbone) == [
+        ("Body", MODEL.Shape.elements["Face6"])
+    ]
+    assert marlin_post.op_toolcontroller(dogbone) is tc1
+    assert marlin_post.op_features(Obj(Base=[], Path=path())) is None
+
+
+def test_features_overlap():
+    face = marlin_post.op_features(operation("a", None, ("Face6",)))
+    edge = marlin_post.op_features(operation("b", None, ("Edge1",)))
+    far = marlin_post.op_features(operation("c", None, ("Face9",)))
+    assert marlin_post.features_overlap(face, edge)
+    assert not marlin_post.features_overlap(face, far)
+    assert marlin_post.features_overlap(face, None)
+    # without shape information subelements of the same object overlap
+    assert marlin_post.features_overlap(
+        [("Body", None)], [("Body", box(0, 0, 0, 1, 1, 1))]
+    )
+    assert not marlin_post.features_overlap([("Body", None)], [("Other", None)])
+
+
+def test_sequence_groups_by_tool():
+    tc1 = toolcontroller("TC1", 1)
+    tc3 = toolcontroller("TC3", 3)
+    rough = operation("rough", tc1, ("Face6",), (0, 0), (10, 0))
+    drill = operation("drill", tc3, ("Face9",), (120, 120))
+    finish = operation("finish", tc1, ("Face6",), (10, 0), (20, 0))
+    result, report = marlin_post.sequence_operations(
+        [tc1, rough, tc3, drill, tc1, finish]
+    )
+    assert labels(result) == ["TC1", "rough", "finish", "TC3", "drill"]
+    assert report[0] == "tool sequencing: tool changes 3 -> 2"
+
+
+def test_sequence_keeps_dressups_with_their_tool():
+    tc1 = toolcontroller("TC1", 1)
+    tc3 = toolcontroller("TC3", 3)
+    rough = operation("rough", tc1, ("Face6",), (0, 0))
+    dogbone = Obj(Label="dogbone", Base=rough, Path=path((0, 0)))
+    drill = operation("drill", tc3, ("Face9",), (120, 120))
+    finish = operation("finish", tc1, ("Face6",), (10, 0))
+    result, report = marlin_post.sequence_operations(
+        [tc1, dogbone, tc3, drill, tc1, finish]
+    )
+    assert labels(result) == ["TC1", "dogbone", "finish", "TC3", "drill"]
+
+
+def test_sequence_keeps_finishing_after_roughing():
+    tc1 = toolcontroller("TC1", 1)
+    tc2 = toolcontroller("TC2", 2)
+    rough = operation("rough", tc1, ("Face6",), (0, 0))
+    pocket = operation("pocket", tc2, ("Face9",), (120, 120))
+    finish = operation("finish", tc2, ("Edge1",), (0, 0))
+    result, report = marlin_post.sequence_operations(
+        [tc1, rough, tc2, pocket, finish]
+    )
+    order = labels(result)
+    assert order.index("rough") < order.index("finish")
+
+
+def test_sequence_explicit_dependency_as_string():
+    tc1 = toolcontroller("TC1", 1)
+    tc3 = toolcontroller("TC3", 3)
+    rough = operation("rough", tc1, ("Face6",), (0, 0))
+    drill = operation("drill", tc3, ("Face9",), (120, 120))
+    finish = operation("finish", tc1, ("Face6",), (10, 0), SequenceAfter="drill")
+    result, report = marlin_post.sequence_operations(
+        [tc1, rough, tc3, drill, tc1, finish]
+    )
+    assert labels(result) == ["TC1", "rough", "TC3", "drill", "TC1", "finish"]
+
+
+def test_sequence_tool_controllers_sharing_a_tool_number():
+    rough_tc = toolcontroller("TC1_rough", 1)
+    finish_tc = toolcontroller("TC1_finish", 1)
+    tc3 = toolcontroller("TC3", 3)
+    rough = operation("rough", rough_tc, ("Face6",), (0, 0))
+    drill = operation("drill", tc3, ("Face9",), (120, 120))
+    finish = operation("finish", finish_tc, ("Face6",), (10, 0))
+    result, report = marlin_post.sequence_operations(
+        [rough_tc, rough, tc3, drill, finish_tc, finish]
+    )
+    assert labels(result) == [
+        "TC1_rough",
+        "rough",
+        "TC1_finish",
+        "finish",
+        "TC3",
+        "drill",
+    ]
+
+
+def test_sequence_skips_inactive_operations():
+    tc1 = toolcontroller("TC1", 1)
+    tc3 = toolcontroller("TC3", 3)
+    tc5 = toolcontroller("TC5", 5)
+    rough = operation("rough", tc1, ("Face6",), (0, 0))
+    drill = operation("drill", tc3, ("Face9",), (120, 120))
+    finish = operation("finish", tc1, ("Face6",), (10, 0))
+    chamfer = operation("chamfer", tc5, ("Face9",), (120, 120), Active=False)
+    result, report = marlin_post.sequence_operations(
+        [tc1, rough, tc3, drill, tc1, finish, tc5, chamfer]
+    )
+    assert labels(result) == ["TC1", "rough", "finish", "TC3", "drill"]
+    assert report[0] == "tool sequencing: tool changes 3 -> 2"
+
+
+def test_sequence_never_adds_tool_changes():
+    # The greedy pick starts with TC2 (two ready operations), but op3 needs
+    # op0 first, which would give TC2 -> TC0 -> TC2 -> TC1.
+    tcs = [toolcontroller("TC%d" % n, n) for n in range(3)]
+    ops = [
+        operation("op0", tcs[0], ("Face6",), (0, 0)),
+        operation("op1", tcs[2], ("Face9",), (0, 0)),
+        operation("op2", tcs[2], ("Face9",), (0, 0)),
+        operation("op3", tcs[2], ("Face9",), (0, 0)),
+        operation("op4", tcs[1], ("Face9",), (0, 0)),
+        operation("op5", tcs[1], ("Face9",), (0, 0)),
+    ]
+    ops[3].SequenceAfter = ["op0", "op1", "op2"]
+    ops[4].SequenceAfter = ["op0", "op1"]
+    ops[5].SequenceAfter = ["op0", "op2"]
+    for op in ops:
+        op.Base = [(Obj(Name=op.Label), ("Face1",))]  # no inferred overlap
+    objectslist = [tcs[0], ops[0], tcs[2], ops[1], ops[2], ops[3], tcs[1]]
+    objectslist += [ops[4], ops[5]]
+    result, report = marlin_post.sequence_operations(objectslist)
+    tools = [obj.Name for obj in result if hasattr(obj, "ToolNumber")]
+    assert marlin_post.count_tool_changes(tools) <= 3
+    assert result == objectslist
+    assert report[-1] == "tool sequencing: original order kept"
+
+
+def test_sequence_reports_dependency_cycle_once(capsys):
+    tc1 = toolcontroller("TC1", 1)
+    tc3 = toolcontroller("TC3", 3)
+    rough = operation("rough", tc1, ("Face6",), (0, 0), SequenceAfter="finish")
+    drill = operation("drill", tc3, ("Face9",), (120, 120))
+    finish = operation("finish", tc1, ("Face6",), (10, 0))
+    result, report = marlin_post.sequence_operations(
+        [tc1, rough, tc3, drill, tc1, finish]
+    )
+    assert capsys.readouterr().out.count("dependency cycle") == 1
+    assert report[0].startswith("tool sequencing: dependency cycle")
+
+
+def commands(*items):
+    return [Path.Command(name, parameters) for name, parameters in items]
+
+
+def test_command_envelopes_arc_extents():
+    # half circles from (3, 10) to (3, 20) around (3, 15), radius 5
+    for name, xmin, xmax in (("G2", -2, 3), ("G3", 3, 8)):
+        env_min, env_max = marlin_post.command_envelopes(
+            commands(
+                ("G0", {"X": 3, "Y": 10, "Z": 5}),
+                (name, {"X": 3, "Y": 20, "I": 0, "J": 5}),
+            )
+        )
+        assert env_min[1, 0] == pytest.approx(xmin)
+        assert env_max[1, 0] == pytest.approx(xmax)
+        assert env_min[1, 1] == pytest.approx(10)
+        assert env_max[1, 1] == pytest.approx(20)
+
+
+def test_command_envelopes_full_circle():
+    env_min, env_max = marlin_post.command_envelopes(
+        commands(("G0", {"X": 10, "Y": 1}), ("G2", {"X": 10, "Y": 1, "J": 2}))
+    )
+    assert list(env_min[1, 0:2]) == pytest.approx([8, 1])
+    assert list(env_max[1, 0:2]) == pytest.approx([12, 5])
+
+
+def test_command_envelopes_drill_r_plane():
+    env_min, env_max = marlin_post.command_envelopes(
+        commands(
+            ("G0", {"X": 50, "Y": 50, "Z": 5}),
+            ("G81", {"X": 50, "Y": 50, "Z": -3, "R": 2, "F": 100}),
+            ("M6", {"T": 1}),
+        )
+    )
+    assert env_min[1, 2] == -3
+    assert env_max[1, 2] == 2
+    assert numpy.isnan(env_min[2]).all()
+
+
+def test_check_bounds_messages(monkeypatch):
+    cut = Obj(
+        Label="profile",
+        Path=Obj(
+            Commands=commands(
+                ("G0", {"X": 10, "Y": 10, "Z": 5}),
+                ("G1", {"Z": -0.5}),
+            )
+        ),
+    )
+    assert marlin_post.check_bounds(cut) == (
+        "operation profile, command 1 (G1): Z-0.500 (machine -0.500) "
+        "is below minimum 0"
+    )
+    monkeypatch.setitem(marlin_post.WORK_OFFSET, "z", 10)
+    assert marlin_post.check_bounds(cut) is None
+    assert marlin_post.check_bounds(Obj(Label="job", Group=[cut])) is None
+
+    high = Obj(
+        Label="drill",
+        Path=Obj(Commands=commands(("G81", {"Z": 1, "R": 45}))),
+    )
+    assert marlin_post.check_bounds(high) == (
+        "operation drill, command 0 (G81): Z45.000 (machine 55.000) "
+        "is above maximum 50"
+    )
+
+
+def test_command_envelopes_r_word_arcs():
+    # (3, 10) to (3, 20), radius 5: G2 bulges to -X, G3 to +X, and a
+    # negative R takes the long way round a radius 10 circle
+    cases = (
+        ("G2", 5, -2, 3),
+        ("G3", 5, 3, 8),
+        ("G2", -10, 3 - 5 * 3 ** 0.5 - 10, 3),
+    )
+    for name, radius, xmin, xmax in cases:
+        env_min, env_max = marlin_post.command_envelopes(
+            commands(
+                ("G0", {"X": 3, "Y": 10, "Z": 5}),
+                (name, {"X": 3, "Y": 20, "R": radius}),
+            )
+        )
+        assert env_min[1, 0] == pytest.approx(xmin)
+        assert env_max[1, 0] == pytest.approx(xmax)
+
+
+def test_command_envelopes_r_word_without_center():
+    # a radius shorter than half the chord has no center, only end points
+    env_min, env_max = marlin_post.command_envelopes(
+        commands(("G0", {"X": 0, "Y": 0}), ("G2", {"X": 10, "Y": 0, "R": 1}))
+    )
+    assert list(env_min[1, 0:2]) == [10, 0]
+    assert list(env_max[1, 0:2]) == [10, 0]